@@ -143,6 +143,7 @@ class SingleStageTrainerConfig:
     save_predicted_tokens: bool
     save_reconstructed_wave: bool
     use_preprocessed_data: bool
+    num_workers: int = 2
 
 @dataclass
 class DataPreprocessorConfig:
@@ -1,4 +1,5 @@
 import io
+import os
 import random
 import sqlite3
 from functools import partial, wraps
@@ -323,9 +324,19 @@ class PreprocessedDataset(Dataset):
         self.semantic_steps_per_second = semantic_steps_per_second
         self.acoustic_steps_per_second = acoustic_steps_per_second
 
-        self.conn, self.cursor = init_sqlite(str(path / 'preprocessed.db'))
+        self.db_path = str(path / 'preprocessed.db')
+        self.conn, self.cursor = init_sqlite(self.db_path)
         self.cursor.execute('SELECT idx from tokens')
         self.ids = [i[0] for i in self.cursor.fetchall()]
+        self._connection_pid = os.getpid()
+
+    def get_cursor(self):
+        # sqlite connections must not be carried across fork(), so dataloader worker
+        # processes re-open the database the first time they read from it
+        if os.getpid() != self._connection_pid:
+            self.conn, self.cursor = init_sqlite(self.db_path)
+            self._connection_pid = os.getpid()
+        return self.cursor
 
     def __len__(self):
         return len(self.ids)
@@ -390,7 +401,7 @@ class PreprocessedDataset(Dataset):
         # 0 1 2 3 4 5 6 7
 
         if self.stage == 'semantic':
-            clap_token_ids, semantic_token_ids = self.cursor.execute(f'SELECT clap, semantic FROM tokens where idx = ?', (sqlite_idx,)).fetchone()
+            clap_token_ids, semantic_token_ids = self.get_cursor().execute(f'SELECT clap, semantic FROM tokens where idx = ?', (sqlite_idx,)).fetchone()
             clap_token_ids, semantic_token_ids = torch.from_numpy(clap_token_ids.astype(np.int32)), torch.from_numpy(semantic_token_ids.astype(np.int32))
 
             audio_length = self.get_and_assert_audio_length_from_tokens(clap_token_ids=clap_token_ids, semantic_token_ids=semantic_token_ids)
@@ -402,7 +413,7 @@ class PreprocessedDataset(Dataset):
 
             return (clap_token_ids, semantic_token_ids)
         elif self.stage == 'coarse':
-            clap_token_ids, semantic_token_ids, coarse_token_ids = self.cursor.execute(f'SELECT clap, semantic, coarse FROM tokens where idx = ?', (sqlite_idx,)).fetchone()
+            clap_token_ids, semantic_token_ids, coarse_token_ids = self.get_cursor().execute(f'SELECT clap, semantic, coarse FROM tokens where idx = ?', (sqlite_idx,)).fetchone()
             clap_token_ids, semantic_token_ids, coarse_token_ids = torch.from_numpy(clap_token_ids.astype(np.int32)), torch.from_numpy(semantic_token_ids.astype(np.int32)), torch.from_numpy(coarse_token_ids.astype(np.int32))
 
             audio_length = self.get_and_assert_audio_length_from_tokens(clap_token_ids=clap_token_ids, semantic_token_ids=semantic_token_ids, coarse_token_ids=coarse_token_ids)
@@ -415,7 +426,7 @@ class PreprocessedDataset(Dataset):
 
             return (clap_token_ids, semantic_token_ids, coarse_token_ids)
         elif self.stage == 'fine':
-            clap_token_ids, coarse_token_ids, fine_token_ids = self.cursor.execute(f'SELECT clap, coarse, fine FROM tokens where idx = ?', (sqlite_idx,)).fetchone()
+            clap_token_ids, coarse_token_ids, fine_token_ids = self.get_cursor().execute(f'SELECT clap, coarse, fine FROM tokens where idx = ?', (sqlite_idx,)).fetchone()
             clap_token_ids, coarse_token_ids, fine_token_ids = torch.from_numpy(clap_token_ids.astype(np.int32)), torch.from_numpy(coarse_token_ids.astype(np.int32)), torch.from_numpy(fine_token_ids.astype(np.int32))
 
             audio_length = self.get_and_assert_audio_length_from_tokens(clap_token_ids=clap_token_ids, coarse_token_ids=coarse_token_ids, fine_token_ids=fine_token_ids)
@@ -1,4 +1,3 @@
-import itertools
 from dataclasses import dataclass
 
 import torch
@@ -17,7 +16,7 @@ from .utils import (all_rows_have_eos_id, append_eos_id,
                     eval_decorator, exists, float32_to_int16,
                     generate_mask_with_prob, get_embeds, gumbel_sample,
                     int16_to_float32, mask_out_after_eos_id,
-                    round_down_nearest_multiple, top_k, prepare_audio)
+                    remainder_needed_until_multiple, top_k, prepare_audio)
 
 
 @dataclass
@@ -53,6 +52,7 @@ class TokenConditionedTransformer(nn.Module):
         grad_shrink_alpha=0.1,
         use_absolute_position_embeddings=False,
         max_absolute_position_embeddings=262,
+        compile_logit_heads=False,
         **kwargs
     ):
         super().__init__()
@@ -64,23 +64,42 @@ class TokenConditionedTransformer(nn.Module):
         self.use_absolute_position_embeddings = use_absolute_position_embeddings
 
         self.start_tokens = torch.nn.ParameterList()
-        self.logit_weights = torch.nn.ParameterList()
         self.embeddings = torch.nn.ModuleList()
         self.absolute_position_embeddings = torch.nn.ModuleList() if self.use_absolute_position_embeddings else None
         self.eos_ids = []
+        self._repeated_offsets = {}
 
-        for sequence in token_sequences:
+        # all per-sequence logit heads stacked into a single parameter (vocab dim padded
+        # to the largest sequence); the projection reads per-sequence slices of it
+        max_codebook_size_with_eos = max(s.codebook_size + 1 for s in token_sequences)
+        total_quantizers = sum(s.num_quantizers for s in token_sequences)
+        self.logit_weights = nn.Parameter(torch.randn(total_quantizers, max_codebook_size_with_eos, dim))
+        self.logit_weight_slices = []
+
+        quantizer_offset = 0
+        for idx, sequence in enumerate(token_sequences):
             self.start_tokens.append(nn.Parameter(torch.randn(dim)))
             self.eos_ids.append(sequence.codebook_size)
 
             codebook_size_with_eos = sequence.codebook_size + 1
 
             self.embeddings.append(nn.Embedding(codebook_size_with_eos * sequence.num_quantizers, dim))
-            self.logit_weights.append(nn.Parameter(torch.randn(sequence.num_quantizers, codebook_size_with_eos, dim)))
+            self.logit_weight_slices.append((quantizer_offset, quantizer_offset + sequence.num_quantizers, codebook_size_with_eos))
+            quantizer_offset += sequence.num_quantizers
+
+            if sequence.num_quantizers > 1:
+                self.register_buffer(
+                    f'quantizer_offsets_{idx}',
+                    sequence.codebook_size * torch.arange(sequence.num_quantizers),
+                    persistent=False)
 
             if self.use_absolute_position_embeddings:
                 self.absolute_position_embeddings.append(nn.Embedding(max_absolute_position_embeddings, dim))
 
+        # device-resident copy of eos_ids so downstream masking helpers don't lift
+        # a python int onto the device every step
+        self.register_buffer('eos_ids_tensor', torch.tensor(self.eos_ids), persistent=False)
+
         self.transformer = Transformer(
             dim=dim,
             depth=depth,
@@ -93,41 +112,74 @@ class TokenConditionedTransformer(nn.Module):
             **kwargs
         )
 
+        self._compute_logits_fn = self._compute_logits
+        if compile_logit_heads:
+            assert hasattr(torch, 'compile'), 'compile_logit_heads requires pytorch >= 2.0'
+            self._compute_logits_fn = torch.compile(self._compute_logits, mode='reduce-overhead', dynamic=True)
+
+    def _apply(self, *args, **kwargs):
+        # keep the cached device in sync whenever parameters are moved or cast
+        module = super()._apply(*args, **kwargs)
+        self._cached_device = next(self.parameters()).device
+        return module
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints stored one logit head per sequence as logit_weights.{i};
+        # stack and pad them into the single fused parameter so they keep loading
+        legacy_keys = [f'{prefix}logit_weights.{i}' for i in range(len(self.logit_weight_slices))]
+        if all(key in state_dict for key in legacy_keys):
+            stacked = torch.zeros_like(self.logit_weights, device='cpu')
+            for key, (q_start, q_end, codebook_size_with_eos) in zip(legacy_keys, self.logit_weight_slices):
+                stacked[q_start:q_end, :codebook_size_with_eos] = state_dict.pop(key)
+            state_dict[f'{prefix}logit_weights'] = stacked
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @property
     def device(self):
-        return next(self.parameters()).device
+        if not exists(getattr(self, '_cached_device', None)):
+            self._cached_device = next(self.parameters()).device
+        return self._cached_device
+
+    def _get_repeated_offsets(self, idx, sequence, length):
+        """Quantizer offsets repeated across time, cached so the hot path doesn't reallocate them every call."""
+        cached = self._repeated_offsets.get(idx)
+        offsets = getattr(self, f'quantizer_offsets_{idx}')
+        if not exists(cached) or cached.shape[-1] < length or cached.device != offsets.device:
+            cached = offsets.repeat(ceil_div(length, sequence.num_quantizers)).unsqueeze(0)
+            self._repeated_offsets[idx] = cached
+        return cached[:, :length]
 
     def forward(self,
                 *,
                 all_token_ids: List[torch.Tensor],
                 self_attn_mask=None,
                 cond_drop_prob=None,
-                return_only_final_seq_logits=False
+                return_only_final_seq_logits=False,
+                autocast_inference=False
                 ):
         """
         all_token_ids: List of tensors containing token ids. Each element can either be 2 dimensional (batch_size, n_time_steps * num_quantizers) or 3 dimensional (batch_size, n_time_steps, num_quantizers)
                        Each element in list corresponds to one token sequence in self.token_sequences (e.g. semantic, coarse acoustic, fine acoustic, etc.)
 
         return_only_final_seq_logits: If True, only return logits for the final token sequence in self.token_sequences.
+
+        autocast_inference: If True and on CUDA, run the transformer and logit projection under reduced-precision autocast. Only meant for gradient-free sampling.
         """
 
         b, device = all_token_ids[0].shape[0], self.device
 
-        all_token_ids = list(map(lambda t: rearrange(t, 'b ... -> b (...)'), all_token_ids))
+        all_token_ids = [t.flatten(1) for t in all_token_ids]
 
         assert len(all_token_ids) == len(self.token_sequences) == len(self.embeddings)
 
         tokens = []
         start_tokens = []
-        split_at = []
+        n_tokens_per_sequence = []
         for idx, sequence, token_ids, embedding, start_token in zip(range(len(self.token_sequences)), self.token_sequences, all_token_ids, self.embeddings, self.start_tokens):
 
             # add offsets
             if sequence.num_quantizers > 1:
-                offsets = sequence.codebook_size * torch.arange(sequence.num_quantizers, device=device)
-                offsets = repeat(offsets, 'q -> 1 (n q)', n=ceil_div(token_ids.shape[-1], sequence.num_quantizers))
-                offsets = offsets[:, :token_ids.shape[-1]]
-                token_ids = token_ids + offsets
+                token_ids = token_ids + self._get_repeated_offsets(idx, sequence, token_ids.shape[-1])
 
             # get embeddings and prepare for next step
             token_embeddings = get_embeds(embedding, token_ids, pad_id=-1)
@@ -136,18 +188,37 @@ class TokenConditionedTransformer(nn.Module):
                 tokens.append(token_embeddings + position_embeddings)
             else:
                 tokens.append(token_embeddings)
-            start_tokens.append(repeat(start_token, 'd -> b 1 d', b=b))
+            start_tokens.append(start_token.view(1, 1, -1).expand(b, 1, -1))  # zero-copy view, materialized by the buffer fill below
+
+            n_tokens_per_sequence.append(token_embeddings.shape[1] + 1)  # +1 for start token of next sequence
+
+        # fill one preallocated buffer as [start_1, tokens_1, start_2, tokens_2, ...]
+        # rather than concatenating 2N intermediate tensors
+        interleaved = torch.empty((b, sum(n_tokens_per_sequence), tokens[0].shape[-1]), device=device, dtype=tokens[0].dtype)
+        pos = 0
+        for start_token, seq_tokens in zip(start_tokens, tokens):
+            interleaved[:, pos:pos + 1] = start_token
+            interleaved[:, pos + 1:pos + 1 + seq_tokens.shape[1]] = seq_tokens
+            pos += 1 + seq_tokens.shape[1]
+        tokens = interleaved
+
+        if autocast_inference and tokens.is_cuda:
+            # sampling path: run the transformer body and logit projection on tensor cores in
+            # reduced precision. training and validation precision stay owned by the trainer's
+            # accelerate mixed_precision setting, so autocast here is explicitly opt-in
+            amp_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+            with torch.autocast(device_type='cuda', dtype=amp_dtype):
+                tokens = self.transformer(tokens, self_attn_mask=self_attn_mask)
+                return self._compute_logits_fn(tokens, n_tokens_per_sequence, return_only_final_seq_logits)
 
-            n_tokens = token_embeddings.shape[1] + 1 # +1 for start token of next sequence
-            split_at.append(n_tokens if len(split_at) == 0 else split_at[-1] + n_tokens)
+        tokens = self.transformer(tokens, self_attn_mask=self_attn_mask)
 
-        tokens = list(itertools.chain(*zip(start_tokens, tokens)))  # [start_1, tokens_1, start_2, tokens_2, ...]
-        tokens = torch.cat(tokens, dim=1)
+        return self._compute_logits_fn(tokens, n_tokens_per_sequence, return_only_final_seq_logits)
 
-        tokens = self.transformer(tokens, self_attn_mask=self_attn_mask)
+    def _compute_logits(self, tokens, n_tokens_per_sequence, return_only_final_seq_logits=False):
+        """Project transformer outputs to per-sequence logits. Fixed-shape graph once the token sequences are known, so it can be torch.compile'd (see compile_logit_heads)."""
 
-        split_at = split_at[:-1]  # remove last element (total number of tokens)
-        all_pred_tokens = torch.tensor_split(tokens, split_at, dim=1)
+        all_pred_tokens = torch.split(tokens, n_tokens_per_sequence, dim=1)
 
         # strip next start token from end of every sequence besides last
         # in tokens: s1 t1 t2 t3 t4 .. e1   s2 t1 t2 t3 t4 e2
@@ -158,30 +229,27 @@ class TokenConditionedTransformer(nn.Module):
         # get logits
 
         all_logits = []
-        assert len(all_pred_tokens) == len(self.token_sequences) == len(self.logit_weights)
+        assert len(all_pred_tokens) == len(self.token_sequences) == len(self.logit_weight_slices)
 
-        for index, (sequence, pred_tokens, seq_logit_weights) in enumerate(zip(self.token_sequences, all_pred_tokens, self.logit_weights)):
+        for index, (sequence, pred_tokens, (q_start, q_end, codebook_size_with_eos)) in enumerate(zip(self.token_sequences, all_pred_tokens, self.logit_weight_slices)):
             if not return_only_final_seq_logits or index == len(self.token_sequences) - 1:
+                seq_logit_weights = self.logit_weights[q_start:q_end, :codebook_size_with_eos]
                 n = pred_tokens.shape[1]
-                nq = round_down_nearest_multiple(n, sequence.num_quantizers)
+                padding = remainder_needed_until_multiple(n, sequence.num_quantizers)
 
-                pred_tokens_groupable, pred_tokens_remainder = pred_tokens[:, :nq], pred_tokens[:, nq:]
+                # pad sequence up to a whole number of steps so the projection is a single
+                # batched matmul, then crop the padded logits back off
+                if padding > 0:
+                    pred_tokens = F.pad(pred_tokens, (0, 0, 0, padding))
 
-                pred_tokens_groupable = rearrange(
-                    pred_tokens_groupable, 'b (n q) d -> b n q d', q=sequence.num_quantizers)
+                pred_tokens = pred_tokens.reshape(pred_tokens.shape[0], -1, sequence.num_quantizers, pred_tokens.shape[-1])
 
-                pred_logits_groupable = einsum('q c d, b n q d -> b n q c', seq_logit_weights, pred_tokens_groupable)
+                pred_logits = einsum('q c d, b n q d -> b n q c', seq_logit_weights, pred_tokens)
 
-                pred_logits_groupable = rearrange(pred_logits_groupable, 'b n q c -> b (n q) c')
+                pred_logits = pred_logits.flatten(1, 2)
 
-                remainder_num_tokens_in_step = pred_tokens_remainder.shape[1]
-
-                if remainder_num_tokens_in_step > 0:
-                    pred_logits_remainder = einsum(
-                        'q c d, b q d -> b q c', seq_logit_weights[:remainder_num_tokens_in_step], pred_tokens_remainder)
-                    pred_logits = torch.cat((pred_logits_groupable, pred_logits_remainder), dim=1)
-                else:
-                    pred_logits = pred_logits_groupable
+                if padding > 0:
+                    pred_logits = pred_logits[:, :n]
 
                 all_logits.append(pred_logits)
             else:
@@ -191,18 +259,73 @@ class TokenConditionedTransformer(nn.Module):
 
     def forward_with_cond_scale(
         self,
-        *args,
+        *,
+        all_token_ids: List[torch.Tensor],
+        self_attn_mask=None,
         cond_scale=3,
+        batched_cfg=True,
         **kwargs
     ):
         """Doesn't do anything without the AudioLM-pytorch text conditioning implementation. Just use forward() instead."""
 
-        logits = self.forward(*args, cond_drop_prob=0., **kwargs)
-
         if cond_scale == 1 or not self.has_condition:
-            return logits
+            return self.forward(all_token_ids=all_token_ids, self_attn_mask=self_attn_mask, cond_drop_prob=0., **kwargs)
+
+        if batched_cfg:
+            # run the conditional and unconditional branches as one doubled batch:
+            # a single transformer pass with half the kernel launches of two sequential ones.
+            # the second half of the batch takes the dropped-conditioning path once text conditioning is implemented
+            batched_token_ids = [torch.cat((t, t), dim=0) for t in all_token_ids]
+            batched_mask = torch.cat((self_attn_mask, self_attn_mask), dim=0) if exists(self_attn_mask) else None
+
+            batched_logits = self.forward(
+                all_token_ids=batched_token_ids,
+                self_attn_mask=batched_mask,
+                cond_drop_prob=0.,
+                **kwargs
+            )
+
+            scaled_logits = []
 
-        null_logits = self.forward(*args, cond_drop_prob=1., **kwargs)
+            for batched_seq_logits in batched_logits:
+                if batched_seq_logits is None:
+                    scaled_logits.append(None)
+                else:
+                    seq_logits, null_seq_logits = batched_seq_logits.chunk(2, dim=0)
+                    scaled_logits.append(torch.lerp(null_seq_logits, seq_logits, cond_scale))
+
+            return scaled_logits
+
+        # two separate passes, e.g. when doubling the batch would not fit in memory.
+        # overlap their kernels on two cuda streams so neither pass serializes behind the other
+        forward_kwargs = dict(all_token_ids=all_token_ids, self_attn_mask=self_attn_mask, **kwargs)
+
+        if self.device.type == 'cuda':
+            if not exists(getattr(self, '_cfg_streams', None)):
+                self._cfg_streams = (torch.cuda.Stream(), torch.cuda.Stream())
+
+            # populate any lazily cached module state (the repeated quantizer offsets) on
+            # the current stream before forking, so the side streams only ever read it and
+            # can't race each other filling it in
+            for idx, (sequence, token_ids) in enumerate(zip(self.token_sequences, all_token_ids)):
+                if sequence.num_quantizers > 1:
+                    self._get_repeated_offsets(idx, sequence, token_ids[0].numel())
+
+            cond_stream, null_stream = self._cfg_streams
+            current_stream = torch.cuda.current_stream()
+            cond_stream.wait_stream(current_stream)
+            null_stream.wait_stream(current_stream)
+
+            with torch.cuda.stream(cond_stream):
+                logits = self.forward(cond_drop_prob=0., **forward_kwargs)
+            with torch.cuda.stream(null_stream):
+                null_logits = self.forward(cond_drop_prob=1., **forward_kwargs)
+
+            current_stream.wait_stream(cond_stream)
+            current_stream.wait_stream(null_stream)
+        else:
+            logits = self.forward(cond_drop_prob=0., **forward_kwargs)
+            null_logits = self.forward(cond_drop_prob=1., **forward_kwargs)
 
         scaled_logits = []
 
@@ -210,7 +333,7 @@ class TokenConditionedTransformer(nn.Module):
             if seq_logits is None:
                 scaled_logits.append(None)
             else:
-                scaled_logits.append(null_seq_logits + (seq_logits - null_seq_logits) * cond_scale)
+                scaled_logits.append(torch.lerp(null_seq_logits, seq_logits, cond_scale))
 
         return scaled_logits
 
@@ -243,9 +366,20 @@ class TokenConditionedTransformerWrapper(nn.Module):
 
         assert len(self.token_sequences) == len(self.eos_ids) == len(self.cross_entropy_loss_weights)
 
+    def _apply(self, *args, **kwargs):
+        module = super()._apply(*args, **kwargs)
+        self._cached_device = next(self.parameters()).device
+        return module
+
     @property
     def device(self):
-        return next(self.parameters()).device
+        if not exists(getattr(self, '_cached_device', None)):
+            self._cached_device = next(self.parameters()).device
+        return self._cached_device
+
+    @property
+    def eos_ids_tensor(self):
+        return self.transformer.eos_ids_tensor
 
     @eval_decorator
     @torch.no_grad()
@@ -272,12 +406,12 @@ class TokenConditionedTransformerWrapper(nn.Module):
         if exists(pred_token_ids):
             assert pred_token_ids.shape[0] == batch
             init_pred_time_step = pred_token_ids.shape[1]
-            pred_token_ids = rearrange(pred_token_ids, 'b ... -> b (...)')
+            pred_token_ids = pred_token_ids.flatten(1)
         else:
             init_pred_time_step = 0
             pred_token_ids = torch.empty((batch, 0), device=device, dtype=torch.long)
 
-        pred_sequence_info, pred_eos_id = self.token_sequences[-1], self.eos_ids[-1]
+        pred_sequence_info, pred_eos_id = self.token_sequences[-1], self.eos_ids_tensor[-1]
 
         # batch unique consecutive
         for index, sequence_info in enumerate(self.token_sequences[:-1]):
@@ -289,8 +423,12 @@ class TokenConditionedTransformerWrapper(nn.Module):
 
         # reshape and append eos
         if append_eos_to_conditioning_tokens:
-            conditioning_token_ids = list(map(lambda t: rearrange(t, 'b ... -> b (...)'), conditioning_token_ids))
-            conditioning_token_ids = [append_eos_id(ids, eos_id) for ids, eos_id in zip(conditioning_token_ids, self.eos_ids)]
+            conditioning_token_ids = [t.flatten(1) for t in conditioning_token_ids]
+            conditioning_token_ids = [append_eos_id(ids, eos_id) for ids, eos_id in zip(conditioning_token_ids, self.eos_ids_tensor)]
+
+        # sampling never needs gradients, so reduced-precision autocast is safe here.
+        # validation forwards (also gradient-free) are left alone unless the caller opts in
+        kwargs.setdefault('autocast_inference', True)
 
         # initialize
 
@@ -315,13 +453,13 @@ class TokenConditionedTransformerWrapper(nn.Module):
                 filtered_logits = top_k(last_pred_logits, thres=filter_thres)
                 sampled = gumbel_sample(filtered_logits, temperature=temperature, dim=-1)
 
-                sampled = rearrange(sampled, 'b -> b 1')
+                sampled = sampled.unsqueeze(1)
                 sampled_pred_token_ids = torch.cat((sampled_pred_token_ids, sampled), dim=-1)
 
         sampled_pred_token_ids = mask_out_after_eos_id(
             sampled_pred_token_ids, pred_eos_id, keep_eos=include_eos_in_output)
-        sampled_pred_token_ids = rearrange(
-            sampled_pred_token_ids, 'b (n q) -> b n q', q=pred_sequence_info.num_quantizers)
+        sampled_pred_token_ids = sampled_pred_token_ids.reshape(
+            batch, -1, pred_sequence_info.num_quantizers)
 
         return sampled_pred_token_ids
 
@@ -337,14 +475,14 @@ class TokenConditionedTransformerWrapper(nn.Module):
 
         batch, device = all_token_ids[0].shape[0], self.device
 
-        all_token_ids = list(map(lambda t: rearrange(t, 'b ... -> b (...)'), all_token_ids))
+        all_token_ids = [t.flatten(1) for t in all_token_ids]
 
         if self.training:
             assert not input_has_eos, "train sequences (from clap, wav2vec, etc.) shouldn't come with an eos token"
 
         # append eos to sequences if not already there
         if not input_has_eos:
-            all_token_ids = [append_eos_id(ids, eos_id) for ids, eos_id in zip(all_token_ids, self.eos_ids)]
+            all_token_ids = [append_eos_id(ids, eos_id) for ids, eos_id in zip(all_token_ids, self.eos_ids_tensor)]
 
         if self.unique_consecutive:
             for index, sequence_info in enumerate(self.token_sequences):
@@ -386,7 +524,7 @@ class TokenConditionedTransformerWrapper(nn.Module):
         if not return_loss:
             return all_logits
 
-        all_logits = list(map(lambda t: rearrange(t, 'b n c -> b c n'), all_logits))
+        all_logits = [t.transpose(1, 2) for t in all_logits]
 
         total_logits = 0
         running_loss = 0.
@@ -855,12 +993,19 @@ class MusicLM(nn.Module):
         self.clap = clap
         self.neural_codec = neural_codec
 
+    def _apply(self, *args, **kwargs):
+        module = super()._apply(*args, **kwargs)
+        self._cached_device = next(self.parameters()).device
+        return module
+
     @property
     def device(self):
-        return next(self.parameters()).device
+        if not exists(getattr(self, '_cached_device', None)):
+            self._cached_device = next(self.parameters()).device
+        return self._cached_device
 
     @eval_decorator
-    @torch.no_grad()
+    @torch.inference_mode()
     def forward(
         self,
         *,
@@ -895,6 +1040,11 @@ class MusicLM(nn.Module):
         fine_token_adjustment = 0
         if exists(prime_wave):
             assert exists(prime_wave_sample_hz)
+            if prime_wave.device.type == 'cpu' and self.device.type == 'cuda':
+                # pinned + async copy so the transfer overlaps the clap/semantic work instead of stalling on it
+                prime_wave = prime_wave.pin_memory().to(self.device, non_blocking=True)
+            else:
+                prime_wave = prime_wave.to(self.device)
             prime_wave_wav2vec = prepare_audio(
                 prime_wave,
                 prime_wave_sample_hz,
@@ -1035,7 +1185,7 @@ class MusicLM(nn.Module):
         return wave
 
     @eval_decorator
-    @torch.no_grad()
+    @torch.inference_mode()
     def generate_top_match(
         self,
         *,
@@ -138,6 +138,7 @@ class SingleStageTrainer(nn.Module):
         lr=3e-4,
         lr_warmup=0,
         grad_accum_every=1,
+        num_workers=2,
         wd=0.,
         max_grad_norm=0.5,
         valid_frac=0.05,
@@ -282,12 +283,23 @@ class SingleStageTrainer(nn.Module):
 
         # dataloader
 
+        # pinned memory + persistent workers so host-to-device copies overlap compute
+        # instead of stalling each step on a pageable copy. PreprocessedDataset re-opens
+        # its sqlite connection per worker process, so workers are safe on both paths
+        dataloader_kwargs = dict(
+            batch_size=batch_size,
+            shuffle=True,
+            pin_memory=torch.cuda.is_available(),
+            num_workers=num_workers,
+            persistent_workers=num_workers > 0,
+        )
+
         if self.use_preprocessed_data:
-            self.dl = get_preprocessed_dataloader(self.ds, batch_size=batch_size, shuffle=True)
-            self.valid_dl = get_preprocessed_dataloader(self.valid_ds, batch_size=batch_size, shuffle=True)
+            self.dl = get_preprocessed_dataloader(self.ds, **dataloader_kwargs)
+            self.valid_dl = get_preprocessed_dataloader(self.valid_ds, **dataloader_kwargs)
         else:
-            self.dl = get_dataloader(self.ds, batch_size=batch_size, shuffle=True)
-            self.valid_dl = get_dataloader(self.valid_ds, batch_size=batch_size, shuffle=True)
+            self.dl = get_dataloader(self.ds, **dataloader_kwargs)
+            self.valid_dl = get_dataloader(self.valid_ds, **dataloader_kwargs)
 
         # prepare with accelerator
 
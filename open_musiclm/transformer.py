@@ -176,7 +176,8 @@ class Attention(nn.Module):
         num_null_kv=0,
         dropout=0.1,
         scale=8,
-        use_memory_efficient_attention=False
+        use_memory_efficient_attention=False,
+        use_sdpa=True
     ):
         super().__init__()
         self.heads = heads
@@ -188,6 +189,9 @@ class Attention(nn.Module):
         if self.use_memory_efficient_attention and not is_xformers_available:
             raise ImportError("Please install xformers to use memory efficient attention")
 
+        # fused attention through F.scaled_dot_product_attention, used when xformers isn't requested
+        self.use_sdpa = use_sdpa and hasattr(F, 'scaled_dot_product_attention')
+
         inner_dim = dim_head * heads
 
         dim_context = default(dim_context, dim)
@@ -300,6 +304,50 @@ class Attention(nn.Module):
             # merge heads
             out = rearrange(out, 'b n h d -> b n (h d)')
 
+        elif self.use_sdpa:
+            # fold bias, padding mask and causality into one additive/boolean mask,
+            # then let pytorch pick the fused kernel (flash / mem-efficient / math)
+            if exists(attn_bias):
+                attn_bias = F.pad(attn_bias, (self.num_null_kv, 0), value=0.)
+                sdpa_mask = attn_bias.unsqueeze(0)
+
+                if exists(mask):
+                    mask = F.pad(mask, (self.num_null_kv, 0), value=True)
+                    mask = rearrange(mask, 'b j -> b 1 1 j')
+                    sdpa_mask = sdpa_mask.masked_fill(~mask, -torch.finfo(sdpa_mask.dtype).max)
+            elif exists(mask):
+                mask = F.pad(mask, (self.num_null_kv, 0), value=True)
+                sdpa_mask = rearrange(mask, 'b j -> b 1 1 j')
+            else:
+                sdpa_mask = None
+
+            if self.causal:
+                i, j = q.shape[-2], k.shape[-2]
+                causal_mask = torch.ones((i, j), dtype=torch.bool, device=x.device).triu(j - i + 1)
+
+                if self.non_causal_prefix > 0:
+                    causal_mask[:self.non_causal_prefix, :(self.non_causal_prefix + j - i)] = False
+
+                if not exists(sdpa_mask):
+                    sdpa_mask = ~causal_mask
+                elif sdpa_mask.dtype == torch.bool:
+                    sdpa_mask = sdpa_mask & ~causal_mask
+                else:
+                    sdpa_mask = sdpa_mask.masked_fill(causal_mask, -torch.finfo(sdpa_mask.dtype).max)
+
+            if exists(sdpa_mask) and sdpa_mask.dtype != torch.bool:
+                sdpa_mask = sdpa_mask.to(q.dtype)
+
+            # fold the fixed qk-norm scale into sdpa's default 1 / sqrt(d) scaling
+            q = q * (self.scale * math.sqrt(q.shape[-1]))
+            k = k.unsqueeze(1).expand(-1, self.heads, -1, -1)
+            v = v.unsqueeze(1).expand(-1, self.heads, -1, -1)
+
+            out = F.scaled_dot_product_attention(q, k, v, attn_mask=sdpa_mask, dropout_p=self.dropout if self.training else 0.)
+
+            # merge heads
+            out = rearrange(out, 'b h n d -> b n (h d)')
+
         else:
             sim = einsum('b h i d, b j d -> b h i j', q, k) * self.scale
 
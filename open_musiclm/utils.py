@@ -1,15 +1,12 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
-from torch.nn.utils.rnn import pad_sequence
 from beartype import beartype
 from pathlib import Path
 import shutil
 import os
 from torchaudio.functional import resample
 
-from einops import rearrange, repeat, reduce
-
 def beartype_jit(func):
     """decorator to enable beartype only if USE_BEARTYPE is set to 1"""
     return beartype(func) if os.environ.get('USE_BEARTYPE', '0') == '1' else func
@@ -110,15 +107,30 @@ def prob_mask_like(shape, prob, device):
 # important detail noted by @eonglints
 
 def append_eos_id(ids, eos_id):
+    # eos_id can be a python int or a scalar tensor (e.g. a slice of a registered buffer);
+    # a tensor already on the right device avoids a host-to-device lift per call
     b, device = ids.shape[0], ids.device
-    eos_ids = torch.ones(1, device = device).long() * eos_id
-    eos_ids = repeat(eos_ids, '1 -> b 1', b = b)
+    if torch.is_tensor(eos_id):
+        eos_ids = eos_id.to(device = device, dtype = ids.dtype).view(1, 1).expand(b, 1)
+    else:
+        eos_ids = torch.full((b, 1), eos_id, device = device, dtype = ids.dtype)
     ids = torch.cat((ids, eos_ids), dim = -1)
     return ids
 
 def batch_unique_consecutive(t, pad_value = 0.):
-    unique_arr = [torch.unique_consecutive(el) for el in t.unbind(dim = 0)]
-    return pad_sequence(unique_arr, batch_first = True, padding_value = pad_value)
+    # vectorized equivalent of per-row torch.unique_consecutive + pad_sequence,
+    # so no python loop over the batch runs inside the decoding path
+    if t.shape[-1] == 0:
+        return t.clone()
+
+    keep = F.pad(t[:, 1:] != t[:, :-1], (1, 0), value = True)
+    lengths = keep.sum(dim = -1)
+
+    out = t.new_full((t.shape[0], int(lengths.max())), pad_value)
+    positions = keep.cumsum(dim = -1) - 1
+    rows = torch.arange(t.shape[0], device = t.device).unsqueeze(-1).expand_as(t)
+    out[rows[keep], positions[keep]] = t[keep]
+    return out
 
 # to get embedding from sequence with padding token
 
@@ -132,10 +144,10 @@ def get_embeds(
 ):
     pad_mask = codes == pad_id
     codes_without_pad = codes.masked_fill(pad_mask, 0) # just retrieve first code as dummy
-    embeds = embeddings(codes_without_pad)
+    embeds = F.embedding(codes_without_pad, embeddings.weight) # skip the nn.Embedding __call__ machinery on the hot path
 
     if exists(mask_pad_pos_to):
-        embeds = embeds.masked_fill(rearrange(pad_mask, '... -> ... 1'), mask_pad_pos_to)
+        embeds = embeds.masked_fill(pad_mask.unsqueeze(-1), mask_pad_pos_to)
 
     if return_mask:
         return embeds, ~pad_mask
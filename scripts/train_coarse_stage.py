@@ -35,6 +35,15 @@ if __name__ == '__main__':
 
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
+    # allocator / matmul settings for long training runs: cap block splitting to reduce
+    # fragmentation across variable-length batches, and let matmuls use tf32 tensor cores.
+    # must be set before the first cuda allocation, i.e. before any model is constructed
+    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'max_split_size_mb:512')
+    torch.backends.cudnn.benchmark = True
+    torch.set_float32_matmul_precision('high')
+    if torch.cuda.is_available():
+        torch.cuda.set_per_process_memory_fraction(0.95)
+
     use_preprocessed_data = training_config.coarse_trainer_cfg.use_preprocessed_data
 
     if use_preprocessed_data:
@@ -66,7 +75,8 @@ if __name__ == '__main__':
         device=device,
         accelerate_kwargs={
             'log_with': "tensorboard",
-            'logging_dir': './logs/coarse'
+            'logging_dir': './logs/coarse',
+            'mixed_precision': 'bf16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'no',
         },
         config_paths=[args.model_config, args.training_config])
 